@@ -0,0 +1,7 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "gthread"
+workers = int(os.getenv("WORKERS", "2"))
+threads = int(os.getenv("THREADS", "16"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
@@ -1,19 +1,55 @@
 import os
 import io
+import logging
+import re
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import unquote
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from google.cloud import storage
+from google.api_core.exceptions import GoogleAPICallError, NotFound, RequestRangeNotSatisfiable
 import google.generativeai as genai
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pdfplumber
 
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
+
 app = Flask(__name__)
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 
 CORS(app, origins=["https://healthcare-patient-portal.web.app"])
 
 BUCKET_NAME = "upload-documents-report"
+GCS_PUBLIC_URL_PREFIX = f"https://storage.googleapis.com/{BUCKET_NAME}/"
 ALLOWED_EXTENSIONS = {'pdf', 'txt', 'doc', 'docx', 'png', 'jpg', 'jpeg'}
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_TIMEOUT_SECONDS = 60
+MAX_REPORT_BYTES = 20 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 3 attempts x (3 s connect + 6 s read) plus 1 s of backoff stays under Dialogflow CX's 30 s webhook limit
+REPORT_FETCH_TIMEOUT = (3, 6)
+MAX_REPORT_CHARS = 24000
+REPORT_HEAD_CHARS = 4000
+LINE_SNAP_CHARS = 200
+TRUNCATION_MARKER = "\n...\n"
+# Raw text kept around each cut before normalizing; whitespace rarely shrinks a report 4x
+NORMALIZE_WINDOW_FACTOR = 4
+MAX_PDF_PAGES = 5
+MIN_SUMMARY_CHARS = 200
+LINE_BREAK_RE = re.compile(r"\s*\n\s*")
+HORIZONTAL_WHITESPACE_RE = re.compile(r"[^\S\n]+")
+PDF_SIGNATURE = b"%PDF"
+BINARY_SIGNATURES = (b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"PK\x03\x04", b"\xd0\xcf\x11\xe0")
 
 GENAI_API_KEY = os.getenv("GEMINI_API_KEY")
 if GENAI_API_KEY:
@@ -29,47 +65,232 @@ CANDIDATE_MODELS = [
 ]
 AVAILABLE_MODELS = [m.name for m in genai.list_models()]
 DEFAULT_MODEL = next((m for m in CANDIDATE_MODELS if m in AVAILABLE_MODELS), "models/gemini-2.5-flash")
-print(f"Using Gemini model: {DEFAULT_MODEL}")
+logger.info("Using Gemini model: %s", DEFAULT_MODEL)
+
+STORAGE_CLIENT = storage.Client()
+BUCKET = STORAGE_CLIENT.bucket(BUCKET_NAME)
+
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+))
+
+SUMMARY_CACHE_SIZE = 512
+SUMMARY_CACHE_TTL_SECONDS = 24 * 60 * 60
+SUMMARY_CACHE = OrderedDict()
+SUMMARY_CACHE_LOCK = threading.Lock()
+
+MODEL_CACHE = {}
+
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_SEMAPHORE = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+WEBHOOK_TIMEOUT_SECONDS = int(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "30"))
+# Past this, Dialogflow will have given up before Gemini could answer
+GEMINI_QUEUE_TIMEOUT_SECONDS = WEBHOOK_TIMEOUT_SECONDS / 3
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def upload_to_gcs(file_obj, filename):
-    client = storage.Client()
-    bucket = client.bucket(BUCKET_NAME)
-    blob = bucket.blob(filename)
-    blob.upload_from_file(file_obj, content_type=file_obj.content_type)
-    return f"https://storage.googleapis.com/{BUCKET_NAME}/{filename}"
+def file_size(file_obj):
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return size
+
+
+def upload_to_gcs(file_obj, filename, size):
+    blob = BUCKET.blob(filename, chunk_size=UPLOAD_CHUNK_SIZE)
+    blob.upload_from_file(
+        file_obj,
+        size=size,
+        content_type=file_obj.content_type,
+        checksum="crc32c",
+        timeout=UPLOAD_TIMEOUT_SECONDS
+    )
+    return f"{GCS_PUBLIC_URL_PREFIX}{filename}"
+
+
+def fetch_report_from_gcs(blob_name):
+    # Ask for one byte past the cap to detect oversize reports
+    try:
+        content = BUCKET.blob(blob_name).download_as_bytes(end=MAX_REPORT_BYTES, timeout=(5, 15))
+    except NotFound:
+        logger.warning("Report not found in bucket: %s", blob_name)
+        return 404, None
+    except RequestRangeNotSatisfiable:
+        # GCS answers 416 to a ranged read of a zero-byte object
+        return 200, b""
+    except GoogleAPICallError as e:
+        # The error text carries internal URLs and the service account, so surface only the status code
+        logger.error("GCS report fetch failed for %s: %s", blob_name, e)
+        return e.code or 500, None
+    logger.debug("Report fetched from GCS (%d bytes)", len(content))
+    if len(content) > MAX_REPORT_BYTES:
+        logger.warning("Report exceeded %d bytes", MAX_REPORT_BYTES)
+        return 200, None
+    return 200, content
+
+
+def fetch_report(file_url):
+    if file_url.startswith(GCS_PUBLIC_URL_PREFIX):
+        blob_name = unquote(file_url[len(GCS_PUBLIC_URL_PREFIX):].split('?', 1)[0])
+        return fetch_report_from_gcs(blob_name)
+
+    with SESSION.get(
+        file_url,
+        timeout=REPORT_FETCH_TIMEOUT,
+        stream=True,
+        headers={"Accept-Encoding": "identity"}
+    ) as response:
+        logger.debug("Report fetch status: %s", response.status_code)
+        if response.status_code != 200:
+            return response.status_code, None
+        content_length = int(response.headers.get("Content-Length") or 0)
+        if content_length > MAX_REPORT_BYTES:
+            logger.warning("Report too large (%d bytes)", content_length)
+            return response.status_code, None
+        # Content-Length may be absent or wrong, so enforce the cap while reading too
+        content = bytearray()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            content += chunk
+            if len(content) > MAX_REPORT_BYTES:
+                logger.warning("Report exceeded %d bytes while downloading", MAX_REPORT_BYTES)
+                return response.status_code, None
+        return response.status_code, content
+
+
+def iter_page_texts(pdf, max_pages=MAX_PDF_PAGES):
+    for page in pdf.pages[:max_pages]:
+        text = page.extract_text()
+        page.flush_cache()
+        if text:
+            yield text
 
 
 def extract_text_from_pdf_bytes(pdf_bytes):
-    print("Starting PDF extraction...")
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        text = "\n".join([page.extract_text() for page in pdf.pages[:5] if page.extract_text()])
-    print(f"Extracted text from PDF ({len(text)} chars)")
+    logger.debug("Starting PDF extraction")
+    with pdfplumber.open(io.BytesIO(pdf_bytes), pages=list(range(1, MAX_PDF_PAGES + 1))) as pdf:
+        text = "\n".join(iter_page_texts(pdf))
+    logger.debug("Extracted text from PDF (%d chars)", len(text))
     return text
 
 
+def summary_cache_key(prompt, model_name):
+    return hashlib.sha256(f"{model_name}\n{prompt}".encode('utf-8')).hexdigest()
+
+
+def get_cached_summary(key):
+    with SUMMARY_CACHE_LOCK:
+        entry = SUMMARY_CACHE.get(key)
+        if entry is None:
+            return None
+        cached_at, summary = entry
+        if time.monotonic() - cached_at > SUMMARY_CACHE_TTL_SECONDS:
+            del SUMMARY_CACHE[key]
+            return None
+        SUMMARY_CACHE.move_to_end(key)
+        return summary
+
+
+def cache_summary(key, summary):
+    with SUMMARY_CACHE_LOCK:
+        SUMMARY_CACHE[key] = (time.monotonic(), summary)
+        SUMMARY_CACHE.move_to_end(key)
+        while len(SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+            SUMMARY_CACHE.popitem(last=False)
+
+
+def get_model(model_name):
+    model = MODEL_CACHE.get(model_name)
+    if model is None:
+        model = MODEL_CACHE.setdefault(model_name, genai.GenerativeModel(model_name))
+    return model
+
+
+def response_text(response):
+    try:
+        return response.candidates[0].content.parts[0].text.strip()
+    except (AttributeError, IndexError):
+        return ""
+
+
 def summarize_with_gemini(prompt: str, model_name=DEFAULT_MODEL):
-    print("Sending prompt to Gemini:", prompt[:200])
+    cache_key = summary_cache_key(prompt, model_name)
+    cached = get_cached_summary(cache_key)
+    if cached is not None:
+        logger.debug("Gemini summary cache hit")
+        return cached
+
+    logger.debug("Sending prompt to Gemini (%d chars)", len(prompt))
     try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content([prompt])
-        print("Gemini raw response:", response)
-        if hasattr(response, "candidates") and response.candidates:
-            summary = response.candidates[0].content.parts[0].text.strip()
-        else:
-            summary = ""
-        print("Gemini summary:", summary[:200])
+        model = get_model(model_name)
+        if not GEMINI_SEMAPHORE.acquire(timeout=GEMINI_QUEUE_TIMEOUT_SECONDS):
+            logger.warning("Timed out after %ss waiting for a Gemini slot", GEMINI_QUEUE_TIMEOUT_SECONDS)
+            return "Error processing the report: the summarization service is busy. Please try again."
+        try:
+            response = model.generate_content([prompt])
+        finally:
+            GEMINI_SEMAPHORE.release()
+        summary = response_text(response)
+        logger.debug("Gemini summary: %.200s", summary)
+        if summary:
+            cache_summary(cache_key, summary)
         return summary
     except Exception as e:
-        print("Gemini error:", str(e))
+        logger.error("Gemini error: %s", e)
         return f"Error processing the report: {str(e)}"
 
 
+def normalize_report_text(text):
+    # Horizontal runs go first; LINE_BREAK_RE backtracks quadratically on long runs without a newline
+    text = HORIZONTAL_WHITESPACE_RE.sub(" ", text.strip())
+    return LINE_BREAK_RE.sub("\n", text)
+
+
+def truncate_report_text(text):
+    if len(text) <= MAX_REPORT_CHARS:
+        return text
+    tail_chars = MAX_REPORT_CHARS - REPORT_HEAD_CHARS - len(TRUNCATION_MARKER)
+    tail_start = len(text) - tail_chars
+    head_end = text.rfind("\n", REPORT_HEAD_CHARS - LINE_SNAP_CHARS, REPORT_HEAD_CHARS)
+    if head_end == -1:
+        head_end = REPORT_HEAD_CHARS
+    tail_break = text.find("\n", tail_start, tail_start + LINE_SNAP_CHARS)
+    if tail_break != -1:
+        tail_start = tail_break + 1
+    return f"{text[:head_end]}{TRUNCATION_MARKER}{text[tail_start:]}"
+
+
+def bound_report_text(text):
+    # Normalizing a multi-MB report holds the GIL for ~1 s; only its ends can survive truncation
+    head_chars = REPORT_HEAD_CHARS * NORMALIZE_WINDOW_FACTOR
+    tail_chars = (MAX_REPORT_CHARS - REPORT_HEAD_CHARS) * NORMALIZE_WINDOW_FACTOR
+    if len(text) <= head_chars + tail_chars:
+        return text
+    return f"{text[:head_chars]}{TRUNCATION_MARKER}{text[-tail_chars:]}"
+
+
 def ai_summarize(report_content):
+    original_length = len(report_content)
+    report_content = normalize_report_text(bound_report_text(report_content))
+    if len(report_content) < MIN_SUMMARY_CHARS:
+        logger.info("Short report (%d chars), skipping Gemini", len(report_content))
+        return f"Short report, full text: {report_content}"
+
+    if len(report_content) > MAX_REPORT_CHARS:
+        report_content = truncate_report_text(report_content)
+        logger.info("Truncated report_content from %d to %d chars", original_length, len(report_content))
+
     # Only generate doctor summary
     prompt_doctor = (
         "Summarize the following medical report for a doctor, highlighting key findings, clinical concerns, "
@@ -80,9 +301,14 @@ def ai_summarize(report_content):
     return doctor_summary
 
 
+@app.errorhandler(413)
+def file_too_large(e=None):
+    return jsonify({'error': f'File too large (max {MAX_REPORT_BYTES // (1024 * 1024)} MB)'}), 413
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    print("Upload route hit")
+    logger.debug("Upload route hit")
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
@@ -90,18 +316,22 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        unique_filename = f"{int(round(os.times()[4]*1000))}_{filename}"
-        public_url = upload_to_gcs(file, unique_filename)
-        print(f"Returning fileUrl: {public_url}")
+        size = file_size(file)
+        # The webhook refuses reports over MAX_REPORT_BYTES, so don't store them
+        if size > MAX_REPORT_BYTES:
+            return file_too_large()
+        unique_filename = f"{uuid.uuid4().hex}_{filename}"
+        public_url = upload_to_gcs(file, unique_filename, size)
+        logger.debug("Returning fileUrl: %s", public_url)
         return jsonify({'fileUrl': public_url})
     return jsonify({'error': 'Invalid file type'}), 400
 
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    print("Webhook route hit")
+    logger.debug("Webhook route hit")
     body = request.json
-    print(f"Webhook request body: {body}")
+    logger.debug("Webhook session: %s", body.get('sessionInfo', {}).get('session'))
     params = body.get('sessionInfo', {}).get('parameters', {})
     file_url = params.get('file_url')
 
@@ -109,40 +339,41 @@ def webhook():
 
     if file_url:
         try:
-            print("Fetching file from:", file_url)
-            response = requests.get(file_url, timeout=15)
-            print("Report fetch status:", response.status_code)
+            logger.debug("Fetching file from: %s", file_url)
+            status_code, report_bytes = fetch_report(file_url)
 
-            if response.status_code == 200:
-                if file_url.lower().endswith('.pdf'):
-                    report_content = extract_text_from_pdf_bytes(response.content)
+            if status_code == 200 and report_bytes is None:
+                doctor_summary = (
+                    f"The report file is larger than {MAX_REPORT_BYTES // (1024 * 1024)} MB and cannot be processed."
+                )
+            elif status_code == 200:
+                if PDF_SIGNATURE in report_bytes[:1024]:
+                    report_content = extract_text_from_pdf_bytes(report_bytes)
+                elif file_url.lower().endswith('.pdf') or report_bytes.startswith(BINARY_SIGNATURES):
+                    logger.info("Report content is not readable text")
+                    report_content = ""
                 else:
-                    report_content = response.content.decode('utf-8', errors='ignore')
+                    report_content = report_bytes.decode('utf-8', errors='ignore')
 
-                print(f"Extracted report_content: {repr(report_content[:200])}")
+                logger.debug("Extracted report_content: %.200r", report_content)
 
                 if not report_content.strip():
                     doctor_summary = "The report file appears empty or could not be read."
                 else:
                     doctor_summary = ai_summarize(report_content)
 
-                print("✅ Doctor summary generated")
-                print(doctor_summary[:300])
+                logger.debug("Doctor summary generated: %.300s", doctor_summary)
 
             else:
                 doctor_summary = (
-                    f"Could not retrieve the report file (HTTP {response.status_code}). Please try uploading again."
+                    f"Could not retrieve the report file (HTTP {status_code}). Please try uploading again."
                 )
 
         except Exception as e:
-            print("Error processing file:", str(e))
+            logger.error("Error processing file: %s", e)
             doctor_summary = f"Error processing the report: {str(e)}"
 
-    # Debug logs for what we send back to Dialogflow
-    print("Returning to Dialogflow with session parameters:")
-    print({
-        "doctor_summary": doctor_summary[:200]
-    })
+    logger.debug("Returning to Dialogflow with doctor_summary: %.200s", doctor_summary)
 
     return jsonify({
         "sessionInfo": {